@@ -14,29 +14,146 @@ second element in each rewrite pair).
 
 """
 import os
+import re
+import sys
+import difflib
+import functools
+import hashlib
 import importlib
+import pickle
 import pkgutil
 
 import libcst as cst
 
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
-from collections import defaultdict, OrderedDict
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 from setuptools import find_packages
 
+try:
+    from importlib.metadata import version
+except ImportError:  # pragma: no cover
+    # Python < 3.8
+    import pkg_resources
+
+    def version(distribution_name):
+        return pkg_resources.get_distribution(distribution_name).version
+
+
+DEFAULT_CACHE_DIR = Path(".refactor-cache")
+
+LIBCST_VERSION = version("libcst")
+
+# Below this many files, work is done serially instead of in a process pool.
+PARALLEL_MIN_TASKS = 8
+
+
+def load_or_parse(
+    path: Path, cache_dir: Path = DEFAULT_CACHE_DIR, src_bytes: Optional[bytes] = None
+) -> cst.Module:
+    """Parse a source file, reusing a cached `cst.Module` when possible.
+
+    Parsed modules are stored in `cache_dir` under the SHA256 of their source
+    and the LibCST version.  A small per-file index records each file's
+    `st_mtime_ns` and size, so that unchanged files are neither re-parsed nor
+    re-hashed.  The cache is best-effort: any entry that can't be loaded is
+    simply replaced.
+
+    Parameters
+    ----------
+    path: str or `Path`
+        Path of the source file to parse.
+    cache_dir: str or `Path`
+        Directory in which the cached modules are stored.
+    src_bytes: bytes, optional
+        The contents of `path`, when the caller has already read them.
+
+    """
+    path = Path(path)
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    path_stat = os.stat(path)
+    stamp = (path_stat.st_mtime_ns, path_stat.st_size)
+
+    # The index is specific to a LibCST version, so that an upgrade can't
+    # point unchanged files at modules pickled by an older version.
+    path_key = hashlib.sha256(
+        (str(path.resolve()) + LIBCST_VERSION).encode()
+    ).hexdigest()
+    index_file = cache_dir / f"{path_key}.idx"
+
+    try:
+        index_stamp, src_key = pickle.loads(index_file.read_bytes())
+        if index_stamp == stamp:
+            return pickle.loads((cache_dir / f"{src_key}.pkl").read_bytes())
+    except Exception:
+        pass
+
+    if src_bytes is None:
+        src_bytes = path.read_bytes()
+
+    src_key = hashlib.sha256(src_bytes).hexdigest() + LIBCST_VERSION
+    cache_file = cache_dir / f"{src_key}.pkl"
+
+    try:
+        mod_cst = pickle.loads(cache_file.read_bytes())
+    except Exception:
+        # Given `bytes`, LibCST determines the encoding itself (e.g. from a
+        # PEP 263 coding declaration).
+        mod_cst = cst.parse_module(src_bytes)
+        _atomic_write(cache_file, pickle.dumps(mod_cst))
+
+    _atomic_write(index_file, pickle.dumps((stamp, src_key)))
+
+    return mod_cst
+
+
+def _atomic_write(path: Path, data: bytes):
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_template(template: str, **names: str) -> cst.BaseExpression:
+    """Parse an expression template filled in with dotted name strings.
+
+    This is a memoized stand-in for `cst.helpers.parse_template_expression`
+    that's keyed on the string forms of the substituted names.  The returned
+    nodes are shared between callers, which is fine, since CST nodes are
+    immutable.
+    """
+    return cst.parse_expression(template.format(**names))
+
+
+def _get_full_name(node: cst.CSTNode, cache: dict):
+    """Return `cst.helpers.get_full_name_for_node(node)` memoized in `cache`.
+
+    Entries are keyed on `id(node)` and hold a reference to their node, so that
+    ids can't be reused by other nodes while the cache is alive.
+    """
+    cached = cache.get(id(node))
+    if cached is not None and cached[0] is node:
+        return cached[1]
+
+    full_name = cst.helpers.get_full_name_for_node(node)
+    cache[id(node)] = (node, full_name)
+    return full_name
+
 
 @dataclass
 class PythonPackageInfo:
     """An object that computes information about a package's sub-packages and modules."""
 
-    filenames_to_modules: OrderedDict = field(repr=False)
-    fullnames_to_modules: OrderedDict = field(repr=False)
-    fullnames_to_packages: OrderedDict = field(repr=False)
-    packages_to_modules: OrderedDict = field(repr=False)
-    paths_to_packages: OrderedDict = field(repr=False)
-    packages_to_paths: OrderedDict
+    filenames_to_modules: dict = field(repr=False)
+    fullnames_to_modules: dict = field(repr=False)
+    fullnames_to_packages: dict = field(repr=False)
+    packages_to_modules: dict = field(repr=False)
+    paths_to_packages: dict = field(repr=False)
+    packages_to_paths: dict
 
     def __init__(self, pkg_dir):
         pkg_dir = Path(pkg_dir)
@@ -50,30 +167,44 @@ class PythonPackageInfo:
         # first_mod = next(pkgutil.iter_modules(["/tmp/pkg"]))
         # root_init_mod = first_mod.module_finder.find_module("__init__")
 
-        self.fullnames_to_modules = OrderedDict()
-        self.filenames_to_modules = OrderedDict()
-        self.packages_to_modules = OrderedDict()
-        self.packages_to_paths = OrderedDict()
-        self.paths_to_packages = OrderedDict()
-        self.fullnames_to_packages = OrderedDict()
+        self.fullnames_to_modules = {}
+        self.filenames_to_modules = {}
+        self.packages_to_modules = {}
+        self.packages_to_paths = {}
+        self.paths_to_packages = {}
+        self.fullnames_to_packages = {}
 
         for package_name, package_path in package_infos:
             self.packages_to_paths[package_name] = Path(package_path)
             self.paths_to_packages[Path(package_path)] = package_name
 
             pkg_modinfos = []
-            for old_modinfo in pkgutil.iter_modules([package_path]):
-                mod_fullname = f"{package_name}.{old_modinfo.name}"
-                mod_filename = Path(
-                    old_modinfo.module_finder.find_module(
-                        old_modinfo.name
-                    ).get_filename()
-                )
+            pkg_finder = pkgutil.get_importer(package_path)
+
+            # A single directory scan finds both the modules and sub-packages,
+            # instead of asking the finder to locate each one separately.
+            for entry in sorted(os.scandir(package_path), key=lambda e: e.name):
+                if entry.name.endswith(".py") and entry.is_file():
+                    mod_name = entry.name[:-3]
+                    mod_filename = Path(entry.path)
+                    mod_ispkg = False
+                elif entry.is_dir():
+                    mod_name = entry.name
+                    mod_filename = Path(entry.path) / "__init__.py"
+                    mod_ispkg = True
+
+                    if not mod_filename.is_file():
+                        continue
+                else:
+                    continue
+
+                if mod_name == "__init__" or not mod_name.isidentifier():
+                    continue
+
+                mod_fullname = f"{package_name}.{mod_name}"
 
                 # This `ModuleInfo` uses the module's full name
-                new_modinfo = pkgutil.ModuleInfo(
-                    old_modinfo.module_finder, mod_fullname, old_modinfo.ispkg
-                )
+                new_modinfo = pkgutil.ModuleInfo(pkg_finder, mod_fullname, mod_ispkg)
                 pkg_modinfos.append(new_modinfo)
 
                 self.filenames_to_modules[mod_filename] = new_modinfo
@@ -109,6 +240,26 @@ class IndirectImportTransformer(cst.CSTTransformer):
         self.pkg_dir = Path(pkg_dir)
         self.pkg_fullname = self.pkg_info.paths_to_packages[self.pkg_dir]
         self.rewrites = rewrites
+        self._fullname_cache = {}
+
+    def _fullname(self, node: cst.CSTNode):
+        return _get_full_name(node, self._fullname_cache)
+
+    # Only module-scope imports (including those within module-level `if`,
+    # `try`, etc. statements) can introduce package-level references, so
+    # there's no need to descend into new scopes or non-import statements.
+
+    def visit_SimpleStatementLine(self, node: cst.SimpleStatementLine) -> bool:
+        return any(isinstance(stmt, (cst.Import, cst.ImportFrom)) for stmt in node.body)
+
+    def visit_FunctionDef(self, node: cst.FunctionDef) -> bool:
+        return False
+
+    def visit_ClassDef(self, node: cst.ClassDef) -> bool:
+        return False
+
+    def visit_Lambda(self, node: cst.Lambda) -> bool:
+        return False
 
     def leave_Import(
         self, original_node: cst.Import, updated_node: cst.Import
@@ -123,18 +274,16 @@ class IndirectImportTransformer(cst.CSTTransformer):
                 # replaced, because that alias will necessarily serve as a type
                 # of indirect import.
 
-                indirect_ref = cst.helpers.parse_template_expression(
-                    self.pkg_fullname + ".{name}", name=alias.asname.name
-                )
-
                 direct_ref = alias.name
-                indirect_ref_name = cst.helpers.get_full_name_for_node(indirect_ref)
+                indirect_ref_name = (
+                    f"{self.pkg_fullname}.{self._fullname(alias.asname.name)}"
+                )
 
                 self.rewrites[indirect_ref_name] = direct_ref
 
                 name_idxs_to_remove.append(n)
             else:
-                module_fullname = cst.helpers.get_full_name_for_node(alias.name)
+                module_fullname = self._fullname(alias.name)
                 module_package = self.pkg_info.fullnames_to_packages[module_fullname]
 
                 if module_package == self.pkg_fullname:
@@ -188,19 +337,20 @@ class IndirectImportTransformer(cst.CSTTransformer):
             indirect_name = alias.asname.name if alias.asname else alias.name
             direct_name = alias.name
 
-            indirect_ref = cst.helpers.parse_template_expression(
-                self.pkg_fullname + ".{name}", name=indirect_name
-            )
-
-            direct_ref = cst.helpers.parse_template_expression(
-                "{mod}.{name}", mod=mod_name, name=direct_name
-            )
+            # These are plain dotted names, so comparing their strings is
+            # equivalent to comparing their parsed nodes.
+            mod_str = self._fullname(mod_name)
+            direct_name_str = self._fullname(direct_name)
 
-            indirect_ref_name = cst.helpers.get_full_name_for_node(indirect_ref)
+            indirect_ref_name = f"{self.pkg_fullname}.{self._fullname(indirect_name)}"
 
-            if direct_ref.deep_equals(indirect_ref):
+            if f"{mod_str}.{direct_name_str}" == indirect_ref_name:
                 continue
 
+            direct_ref = _parse_template(
+                "{mod}.{name}", mod=mod_str, name=direct_name_str
+            )
+
             self.rewrites[indirect_ref_name] = direct_ref
 
         return cst.RemoveFromParent()
@@ -232,7 +382,6 @@ class RewriteIndirectImportsTransformer(cst.CSTTransformer):
     ) -> Union[cst.Import, cst.RemovalSentinel]:
         # TODO: Replace with direct import.
         # imports_with_indirects
-        breakpoint()
         return updated_node  # .with_changes(names=names_to_keep)
 
     def leave_ImportFrom(
@@ -240,17 +389,97 @@ class RewriteIndirectImportsTransformer(cst.CSTTransformer):
     ) -> Union[cst.ImportFrom, cst.RemovalSentinel]:
         # TODO: Replace with direct import.
         # imports_with_indirects
-        breakpoint()
         return updated_node  # .with_changes(names=names_to_keep)
 
     def leave_Attribute(self, original_node, updated_node):
         # TODO: Replace with direct reference/attribute access
-        breakpoint()
         replacement = self.indirect_references.get(original_node, updated_node)
         return replacement  # .with_changes(names=names_to_keep)
 
 
-def refine_indirect_references(wrapper, rewrites):
+class _RewritesTrie:
+    """A trie over the dot-separated components of rewrite names.
+
+    This allows a dotted name like `pkg.mod3.var4` to be matched against the
+    rewrite for `pkg.mod3` in a single walk.
+    """
+
+    def __init__(self, rewrites=None):
+        self._root = {}
+
+        if rewrites:
+            for dotted_name, replacement in rewrites.items():
+                self.insert(dotted_name, replacement)
+
+    def insert(self, dotted_name, replacement):
+        trie_node = self._root
+        for name_part in dotted_name.split("."):
+            trie_node = trie_node.setdefault(name_part, {})
+
+        # Names can't be `None`, so it's safe to use as the value's key
+        trie_node[None] = replacement
+
+    def longest_prefix(self, dotted_name):
+        """Find the rewrite for the longest prefix of `dotted_name`.
+
+        Returns
+        -------
+        replacement :
+            The matching rewrite, or `None` when no prefix matches.
+        remainder : str
+            The components of `dotted_name` following the matched prefix.
+
+        """
+        name_parts = dotted_name.split(".")
+        replacement, match_len = None, 0
+
+        trie_node = self._root
+        for n, name_part in enumerate(name_parts):
+            trie_node = trie_node.get(name_part)
+            if trie_node is None:
+                break
+            if None in trie_node:
+                replacement, match_len = trie_node[None], n + 1
+
+        if replacement is None:
+            return None, dotted_name
+
+        return replacement, ".".join(name_parts[match_len:])
+
+
+class _AttributeParentProvider(cst.metadata.BatchableMetadataProvider):
+    """Map each `cst.Attribute`'s `value` node to that `cst.Attribute`.
+
+    This is the only part of `ParentNodeProvider`'s information that's needed
+    to walk up dotted names, and it's much cheaper to compute, since only
+    `cst.Attribute` nodes are recorded.
+    """
+
+    def visit_Attribute(self, node: cst.Attribute):
+        self.set_metadata(node.value, node)
+
+
+def _unique_scopes(scope_map):
+    """Return the distinct scopes in a `ScopeProvider` mapping in first-seen order.
+
+    LibCST scopes only link to their parents, so they can't be walked down from
+    the global scope.  Instead, this relies on consecutive nodes almost always
+    sharing a scope and only hashes a scope when it differs from the last one.
+    """
+    scopes = []
+    seen = set()
+    last_scope = None
+    for scope in scope_map.values():
+        if scope is last_scope:
+            continue
+        last_scope = scope
+        if scope not in seen:
+            seen.add(scope)
+            scopes.append(scope)
+    return scopes
+
+
+def refine_indirect_references(wrapper, rewrites, rewrites_trie=None):
     """Find imports and module references within a module using scope-based considerations.
 
     Parameters
@@ -259,6 +488,8 @@ def refine_indirect_references(wrapper, rewrites):
         The module's metadata wrapper object.
     rewrites : dict
         A `dict` of known package-level imports.
+    rewrites_trie : _RewritesTrie, optional
+        A trie built from `rewrites`.  One is constructed when not given.
 
     Returns
     -------
@@ -270,97 +501,242 @@ def refine_indirect_references(wrapper, rewrites):
         node using its direct reference.
 
     """
-    scopes = set(wrapper.resolve(cst.metadata.ScopeProvider).values())
+    if not rewrites:
+        return {}, {}
 
-    imports_with_indirects = defaultdict(set)
-    indirect_references = defaultdict(set)
+    if rewrites_trie is None:
+        rewrites_trie = _RewritesTrie(rewrites)
+
+    # Both providers are batchable, so this resolves them in a single pass
+    # over the tree.
+    metadata = wrapper.resolve_many(
+        [cst.metadata.ScopeProvider, _AttributeParentProvider]
+    )
+
+    scopes = _unique_scopes(metadata[cst.metadata.ScopeProvider])
+
+    imports_with_indirects = {}
+    indirect_references = {}
+    fullname_cache = {}
 
     # qualified_names = wrapper.resolve(cst.metadata.QualifiedNameProvider)
-    parent_nodes = wrapper.resolve(cst.metadata.ParentNodeProvider)
+    attribute_parents = metadata[_AttributeParentProvider]
 
-    # ranges = wrapper.resolve(cst.metadata.PositionProvider)
+    # Only import assignments can introduce indirect references
+    import_assignments = []
     for scope in scopes:
         for assignment in scope.assignments:
             node = getattr(assignment, "node", None)
             if isinstance(assignment, cst.metadata.Assignment) and isinstance(
                 node, (cst.Import, cst.ImportFrom)
             ):
-                # Is this import an indirect reference?  If so, prepare it to be replaced.
-                if isinstance(node, cst.Import):
-                    module_fullnames = [
-                        cst.helpers.get_full_name_for_node(m.name) for m in node.names
-                    ]
-                else:
-                    module_fullnames = [cst.helpers.get_full_name_for_node(node.module)]
+                import_assignments.append((assignment, node))
 
-                for mod_name in module_fullnames:
-                    replacement_module = rewrites.get(mod_name)
+    # ranges = wrapper.resolve(cst.metadata.PositionProvider)
+    for assignment, node in import_assignments:
+        # Is this import an indirect reference?  If so, prepare it to be replaced.
+        if isinstance(node, cst.Import):
+            module_fullnames = [
+                _get_full_name(m.name, fullname_cache) for m in node.names
+            ]
+        else:
+            module_fullnames = [_get_full_name(node.module, fullname_cache)]
+
+        for mod_name in module_fullnames:
+            replacement_module = rewrites.get(mod_name)
+
+            if replacement_module:
+                imports_with_indirects[node] = replacement_module
+
+        # TODO: It seems like we should be using FQNs, no?
+        # scope.get_qualified_names_for("pkg")
+
+        for ref in assignment.references:
+            # Collect the attribute accesses on this reference, up to
+            # the full dotted name (e.g. `pkg.mod3` and
+            # `pkg.mod3.var4` for `pkg` in `pkg.mod3.var4`).  References to
+            # dotted imports (e.g. `import pkg.mod3`) are already attribute
+            # accesses themselves.
+            ref_node = ref.node
+            attr_chain = [ref_node] if isinstance(ref_node, cst.Attribute) else []
+            ref_parent_node = attribute_parents.get(ref_node)
+            while ref_parent_node is not None:
+                attr_chain.append(ref_parent_node)
+                ref_node = ref_parent_node
+                ref_parent_node = attribute_parents.get(ref_node)
+
+            if not attr_chain:
+                continue
 
-                    if replacement_module:
-                        imports_with_indirects[node] = replacement_module
+            ref_fullname = _get_full_name(attr_chain[-1], fullname_cache)
+            replacement_module, remainder = rewrites_trie.longest_prefix(ref_fullname)
 
-                # TODO: It seems like we should be using FQNs, no?
-                # scope.get_qualified_names_for("pkg")
+            if replacement_module is None:
+                continue
 
-                for ref in assignment.references:
-                    ref_parent_node = parent_nodes[ref.node]
-                    if isinstance(ref_parent_node, cst.Attribute):
-                        ref_fullname = cst.helpers.get_full_name_for_node(
-                            ref_parent_node
-                        )
-                        replacement_module = rewrites.get(ref_fullname)
-                        if replacement_module:
-                            indirect_references[ref_parent_node] = replacement_module
+            # The number of trailing attribute accesses that aren't
+            # part of the rewritten name
+            remainder_depth = remainder.count(".") + 1 if remainder else 0
+
+            if remainder_depth < len(attr_chain):
+                ref_attr_node = attr_chain[-1 - remainder_depth]
+                indirect_references[ref_attr_node] = replacement_module
 
     return imports_with_indirects, indirect_references
 
 
-def collect_indirect_references(project_path):
+def _parse_init(pkg_name, pkg_path, cache_dir):
+    return pkg_name, load_or_parse(Path(pkg_path) / "__init__.py", cache_dir)
+
+
+def _analyze_module(mod_path, rewrites, rewrites_trie, candidates_pattern, cache_dir):
+    src_bytes = Path(mod_path).read_bytes()
+
+    # Any reference to a rewritten name must spell out its last component
+    # somewhere in the source, so modules without one can skip the (costly)
+    # metadata resolution altogether.
+    if not candidates_pattern.search(src_bytes):
+        return mod_path, None, None
+
+    mod_cst = load_or_parse(mod_path, cache_dir, src_bytes=src_bytes)
+
+    # `mod_cst` isn't used anywhere else, so there's no need for the wrapper
+    # to copy it.
+    wrapper = cst.metadata.MetadataWrapper(mod_cst, unsafe_skip_copy=True)
+    imports_with_indirects, indirect_references = refine_indirect_references(
+        wrapper, rewrites, rewrites_trie
+    )
+
+    # The rewrites for this module are fixed at this point, so, when there
+    # aren't any, the whole transform and code generation pass can be skipped.
+    if not imports_with_indirects and not indirect_references:
+        return mod_path, None, None
+
+    fixed_module = wrapper.module.visit(
+        RewriteIndirectImportsTransformer(imports_with_indirects, indirect_references)
+    )
+
+    mod_src = mod_cst.code
+    fixed_src = fixed_module.code
+
+    if fixed_src == mod_src:
+        return mod_path, None, None
+
+    return mod_path, mod_src, fixed_src
+
+
+# Arguments shared by every task in a worker process; see `_run_tasks`.
+_worker_shared_args = ()
+
+
+def _set_worker_shared_args(*shared_args):
+    global _worker_shared_args
+    _worker_shared_args = shared_args
+
+
+def _call_with_shared_args(func, args):
+    return func(*args, *_worker_shared_args)
+
+
+def _run_tasks(func, tasks, shared_args=()):
+    """Apply `func` to each argument tuple in `tasks`, in parallel when worthwhile.
+
+    Each call receives `shared_args` after its task's own arguments.  When a
+    process pool is used, `shared_args` are sent to each worker only once,
+    instead of being pickled along with every task.
+
+    Small inputs are processed serially, since the pool's startup cost would
+    outweigh any gains.  Results are yielded in order as they become
+    available, so that callers don't need to hold all of them at once.
+    """
+    if len(tasks) < PARALLEL_MIN_TASKS:
+        for args in tasks:
+            yield func(*args, *shared_args)
+        return
+
+    max_workers = os.cpu_count() or 1
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_set_worker_shared_args,
+        initargs=shared_args,
+    ) as executor:
+        yield from executor.map(
+            functools.partial(_call_with_shared_args, func),
+            tasks,
+            chunksize=max(1, len(tasks) // (4 * max_workers)),
+        )
+
+
+def collect_indirect_references(project_path, cache_dir=None):
 
     project_path = Path(project_path)
     pkg_info = PythonPackageInfo(project_path)
     rewrites = {}
 
+    if cache_dir is None:
+        cache_dir = project_path.parent / DEFAULT_CACHE_DIR
+
     # 1) Find package-level imports that introduce indirect references
+    pkg_init_csts = dict(
+        _run_tasks(
+            _parse_init,
+            [
+                (pkg_name, pkg_path)
+                for pkg_name, pkg_path in pkg_info.packages_to_paths.items()
+            ],
+            shared_args=(cache_dir,),
+        )
+    )
+
+    # The visitors populate `rewrites` in place, so this part stays serial.
     for pkg_name, pkg_path in pkg_info.packages_to_paths.items():
-        pkg_init_src = (pkg_path / "__init__.py").read_text()
-        pkg_init_cst = cst.parse_module(pkg_init_src)
+        pkg_init_cst = pkg_init_csts[pkg_name]
 
         # TODO: This should be a transformer that also removes the indirect references, no?
         import_visitor = IndirectImportTransformer(pkg_info, pkg_path, rewrites)
 
         _ = pkg_init_cst.visit(import_visitor)
 
+    # Without any indirect references there's nothing to replace
+    if not rewrites:
+        return
+
     # 2) Visit each module and replace all the indirect references and imports
-    for mod_path, mod_info in pkg_info.filenames_to_modules:
-        if mod_info.ispkg:
-            mod_path
+    rewrites_trie = _RewritesTrie(rewrites)
+    candidate_names = sorted({k.rsplit(".", 1)[-1] for k in rewrites})
+    # This is matched against undecoded (normally UTF-8) sources, so the name
+    # boundaries are only checked against ASCII identifier characters.  That
+    # can let extra modules through, but it won't skip ones that need
+    # rewriting.
+    candidates_pattern = re.compile(
+        rb"(?<![A-Za-z0-9_])(?:"
+        + b"|".join(re.escape(name.encode("utf-8")) for name in candidate_names)
+        + rb")(?![A-Za-z0-9_])"
+    )
+
+    mod_results = _run_tasks(
+        _analyze_module,
+        [
+            (mod_path,)
+            for mod_path, mod_info in pkg_info.filenames_to_modules.items()
+            if not mod_info.ispkg
+        ],
+        shared_args=(rewrites, rewrites_trie, candidates_pattern, cache_dir),
+    )
+
+    for mod_path, mod_src, fixed_src in mod_results:
+        if fixed_src is None:
             continue
 
-        mod_src = Path(mod_path).read_text()
-        mod_cst = cst.parse_module(mod_src)
-
-        wrapper = cst.metadata.MetadataWrapper(mod_cst)
-        imports_with_indirects, indirect_references = refine_indirect_references(
-            wrapper, rewrites
-        )
-
-        fixed_module = wrapper.module.visit(
-            RewriteIndirectImportsTransformer(
-                imports_with_indirects, indirect_references
-            )
-        )
-
         # Use difflib to show the changes
-        import difflib
-
-        print(
-            "".join(
-                difflib.unified_diff(
-                    mod_src.splitlines(1), fixed_module.code.splitlines(1)
-                )
+        sys.stdout.writelines(
+            difflib.unified_diff(
+                mod_src.splitlines(keepends=True),
+                fixed_src.splitlines(keepends=True),
+                fromfile=str(mod_path),
+                tofile=str(mod_path),
             )
         )
 
-        # if not fixed_module.deep_equals(mod_cst):
-        #     pass  # write to file
+        # TODO: Write `fixed_src` to file.
@@ -6,12 +6,16 @@ from pathlib import Path
 from textwrap import dedent
 from dataclasses import dataclass
 
+import refactors.direct_imports
+
 from refactors.direct_imports import (
     PythonPackageInfo,
     IndirectImportTransformer,
+    load_or_parse,
     # RewriteIndirectImportsTransformer,
-    # refine_indirect_references,
-    # collect_indirect_references,
+    refine_indirect_references,
+    collect_indirect_references,
+    _RewritesTrie,
 )
 
 
@@ -50,6 +54,20 @@ def sample_project(tmpdir):
     import pkg.sub_pkg.mod3 as mod3
 
     var0 = mod3.var4
+
+    # Imports within module-level statements are in the module scope
+    try:
+        from .mod1 import var1 as fast_var1
+    except ImportError:
+        fast_var1 = None
+
+    if True:
+        from pkg.mod2 import var3 as v3
+
+    def func1():
+        # Imports outside of the module scope are left alone
+        from pkg.mod1 import var1 as func_var1
+        return func_var1
     """
         )
     )
@@ -60,6 +78,20 @@ def sample_project(tmpdir):
     import pkg.mod1
 
     var0 = mod3.var4
+
+    # Imports within module-level statements are in the module scope
+    try:
+        pass
+    except ImportError:
+        fast_var1 = None
+
+    if True:
+        pass
+
+    def func1():
+        # Imports outside of the module scope are left alone
+        from pkg.mod1 import var1 as func_var1
+        return func_var1
     """
     )
 
@@ -232,6 +264,8 @@ def test_IndirectImportTransformer(sample_project):
         "pkg.var1": "mod1.var1",
         "pkg.variable2": "mod1.var2",
         "pkg.variable3": "pkg.mod2.var3",
+        "pkg.fast_var1": "mod1.var1",
+        "pkg.v3": "pkg.mod2.var3",
         "pkg.mod3": "pkg.sub_pkg.mod3",
         "pkg.sub_pkg.mod2": "pkg.mod2",
         "pkg.sub_pkg.var1": "pkg.var1",
@@ -240,3 +274,196 @@ def test_IndirectImportTransformer(sample_project):
     txt_rewrites = {k: pkg_init_cst.code_for_node(v) for k, v in rewrites.items()}
 
     assert exp_txt_rewrites == txt_rewrites
+
+
+def test_load_or_parse(sample_project, tmpdir, monkeypatch):
+    cache_dir = Path(tmpdir) / ".refactor-cache"
+    mod_path = sample_project.project_dir / "mod2.py"
+    mod_src = mod_path.read_text()
+
+    mod_cst = load_or_parse(mod_path, cache_dir)
+    assert mod_cst.deep_equals(cst.parse_module(mod_src))
+    assert len(list(cache_dir.glob("*.pkl"))) == 1
+
+    cached_mod_cst = load_or_parse(mod_path, cache_dir)
+    assert cached_mod_cst.deep_equals(mod_cst)
+    assert len(list(cache_dir.glob("*.pkl"))) == 1
+
+    mod_path.write_text(mod_src + "var5 = 5\n")
+
+    new_mod_cst = load_or_parse(mod_path, cache_dir)
+    assert new_mod_cst.code == mod_src + "var5 = 5\n"
+    assert len(list(cache_dir.glob("*.pkl"))) == 2
+
+    # Modules cached by another LibCST version aren't reused
+    monkeypatch.setattr(refactors.direct_imports, "LIBCST_VERSION", "0.0.0")
+
+    load_or_parse(mod_path, cache_dir)
+    assert len(list(cache_dir.glob("*.pkl"))) == 3
+
+    # Unloadable cache entries are replaced
+    for cache_file in cache_dir.glob("*.pkl"):
+        cache_file.write_bytes(b"not a pickle")
+
+    assert load_or_parse(mod_path, cache_dir).deep_equals(new_mod_cst)
+
+    # Sources are parsed as bytes, so PEP 263 encodings are respected
+    latin1_path = sample_project.project_dir / "latin1_mod.py"
+    latin1_src = '# -*- coding: latin-1 -*-\nvar6 = "é"\n'
+    latin1_path.write_bytes(latin1_src.encode("latin-1"))
+
+    assert load_or_parse(latin1_path, cache_dir).code == latin1_src
+
+
+def test_RewritesTrie():
+    rewrites_trie = _RewritesTrie(
+        {"pkg.mod3": "a", "pkg.mod3.var4": "b", "pkg.var1": "c"}
+    )
+
+    assert rewrites_trie.longest_prefix("pkg.mod3") == ("a", "")
+    assert rewrites_trie.longest_prefix("pkg.mod3.var5.lower") == ("a", "var5.lower")
+    assert rewrites_trie.longest_prefix("pkg.mod3.var4.lower") == ("b", "lower")
+    assert rewrites_trie.longest_prefix("pkg.var2") == (None, "pkg.var2")
+    assert rewrites_trie.longest_prefix("pkg") == (None, "pkg")
+
+
+def test_refine_indirect_references():
+    mod_cst = cst.parse_module(
+        dedent(
+            r"""
+    import pkg
+
+    pkg.sub_pkg.var1.lower()
+    print(pkg.mod3.var4)
+    print(pkg.mod1)
+    """
+        )
+    )
+
+    rewrites = {
+        "pkg.sub_pkg.var1": cst.parse_expression("pkg.mod1.var1"),
+        "pkg.mod3": cst.parse_expression("pkg.sub_pkg.mod3"),
+    }
+
+    wrapper = cst.metadata.MetadataWrapper(mod_cst)
+    imports_with_indirects, indirect_references = refine_indirect_references(
+        wrapper, rewrites
+    )
+
+    assert imports_with_indirects == {}
+
+    txt_references = {
+        mod_cst.code_for_node(k): mod_cst.code_for_node(v)
+        for k, v in indirect_references.items()
+    }
+
+    assert txt_references == {
+        "pkg.sub_pkg.var1": "pkg.mod1.var1",
+        "pkg.mod3": "pkg.sub_pkg.mod3",
+    }
+
+    assert refine_indirect_references(wrapper, {}) == ({}, {})
+
+    # References through dotted imports are `Attribute` nodes themselves
+    mod_cst = cst.parse_module(
+        dedent(
+            r"""
+    import pkg.mod3
+
+    print(pkg.mod3)
+    print(pkg.mod3.var4)
+    """
+        )
+    )
+
+    wrapper = cst.metadata.MetadataWrapper(mod_cst)
+    imports_with_indirects, indirect_references = refine_indirect_references(
+        wrapper, rewrites
+    )
+
+    txt_imports = {
+        mod_cst.code_for_node(k): mod_cst.code_for_node(v)
+        for k, v in imports_with_indirects.items()
+    }
+
+    assert txt_imports == {"import pkg.mod3": "pkg.sub_pkg.mod3"}
+
+    txt_references = [
+        (mod_cst.code_for_node(k), mod_cst.code_for_node(v))
+        for k, v in indirect_references.items()
+    ]
+
+    assert txt_references == [
+        ("pkg.mod3", "pkg.sub_pkg.mod3"),
+        ("pkg.mod3", "pkg.sub_pkg.mod3"),
+    ]
+
+
+def test_collect_indirect_references(sample_project, tmpdir, capsys):
+    cache_dir = Path(tmpdir) / ".refactor-cache"
+
+    collect_indirect_references(sample_project.project_dir, cache_dir=cache_dir)
+
+    diff_lines = capsys.readouterr().out.splitlines()
+
+    mod1_path = sample_project.project_dir / "mod1.py"
+    assert f"--- {mod1_path}" in diff_lines
+    assert f"+++ {mod1_path}" in diff_lines
+    assert "-print(pkg.mod3.var4.lower())" in diff_lines
+    assert "+print(pkg.sub_pkg.mod3.var4.lower())" in diff_lines
+
+
+def test_collect_indirect_references_parallel(
+    sample_project, tmpdir, capsys, monkeypatch
+):
+    cache_dir = Path(tmpdir) / ".refactor-cache"
+
+    collect_indirect_references(sample_project.project_dir, cache_dir=cache_dir)
+    serial_out = capsys.readouterr().out
+
+    monkeypatch.setattr(refactors.direct_imports, "PARALLEL_MIN_TASKS", 1)
+
+    collect_indirect_references(sample_project.project_dir, cache_dir=cache_dir)
+    parallel_out = capsys.readouterr().out
+
+    assert serial_out
+    assert parallel_out == serial_out
+
+
+def test_collect_indirect_references_prefilter(tmpdir, capsys, monkeypatch):
+    pkg_dir = Path(tmpdir) / "pkg"
+    sub_pkg_dir = pkg_dir / "sub_pkg"
+    sub_pkg_dir.mkdir(parents=True)
+
+    (pkg_dir / "__init__.py").write_text("import pkg.sub_pkg.mod3 as mod3\n")
+    (sub_pkg_dir / "__init__.py").write_text("")
+    (sub_pkg_dir / "mod3.py").write_text('var4 = "hi"\n')
+
+    # This module doesn't mention any rewritten names
+    no_candidates_path = pkg_dir / "no_candidates.py"
+    no_candidates_path.write_text("import pkg\n\nprint(pkg.sub_pkg)\n")
+
+    # This module only reaches a rewrite through a prefix of `pkg.mod3.var4`
+    prefix_path = pkg_dir / "prefix.py"
+    prefix_path.write_text("import pkg\n\nprint(pkg.mod3.var4)\n")
+
+    parsed_paths = []
+    orig_load_or_parse = refactors.direct_imports.load_or_parse
+
+    def load_or_parse_spy(path, *args, **kwargs):
+        parsed_paths.append(Path(path))
+        return orig_load_or_parse(path, *args, **kwargs)
+
+    monkeypatch.setattr(refactors.direct_imports, "load_or_parse", load_or_parse_spy)
+
+    collect_indirect_references(pkg_dir, cache_dir=Path(tmpdir) / ".refactor-cache")
+
+    assert no_candidates_path not in parsed_paths
+    assert prefix_path in parsed_paths
+
+    diff_lines = capsys.readouterr().out.splitlines()
+
+    assert f"--- {no_candidates_path}" not in diff_lines
+    assert f"--- {prefix_path}" in diff_lines
+    assert "-print(pkg.mod3.var4)" in diff_lines
+    assert "+print(pkg.sub_pkg.mod3.var4)" in diff_lines